@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+crawl_planner.py
+
+Partitioned crawl of the ws-tcg.com card list, one partition per expansion.
+
+Instead of following every link that looks like pagination (as the BFS in
+scrape_ws_cards.py does), the planner:
+- reads the expansion <select> of the search form and builds one partition
+  per option, with canonical result-page URLs (see canonicalize_url)
+- fetches page 1 of every partition to plan its page count, so total
+  progress is known before the bulk of the crawl starts; the count is raised
+  from the pager of every later page (windowed pagers), and any difference
+  from the plan is logged
+- crawls partitions in parallel, one requests.Session per worker thread,
+  each page exactly once
+- writes one JSON file per partition plus manifest.json, so a single
+  expansion can be re-crawled (--only) and an interrupted crawl resumed
+
+Row parsing reuses scrape_ws_cards.parse_card_row.
+
+Usage:
+  python crawl_planner.py --plan-only
+  python crawl_planner.py --out-dir crawl --workers 4
+  python crawl_planner.py --out-dir crawl --only <expansion value>
+  python crawl_planner.py --out-dir crawl --merge weiss_schwarz_cards.json
+
+Requires `requests` and `beautifulsoup4`.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit
+
+from bs4 import BeautifulSoup
+
+from scrape_ws_cards import CARD_TABLE_BODY_SELECTOR, SEARCH_PAGE_URL, canonicalize_url, parse_card_row
+
+try:
+    import requests
+except Exception:
+    requests = None
+
+
+MANIFEST_NAME = 'manifest.json'
+USER_AGENT = 'TCGEngineProject card crawler'
+
+
+class Progress:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages_total = 0
+        self.pages_done = 0
+        self.cards = 0
+
+    def add_total(self, n: int) -> None:
+        with self.lock:
+            self.pages_total += n
+
+    def page_done(self, label: str, page: int, cards: int) -> None:
+        with self.lock:
+            self.pages_done += 1
+            self.cards += cards
+            print(f'[{self.pages_done}/{self.pages_total}] {label} p{page}: {cards} cards')
+
+
+_local = threading.local()
+
+
+def get_session() -> 'requests.Session':
+    # one session (connection pool + cookies) per worker thread
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+        _local.session.headers['User-Agent'] = USER_AGENT
+    return _local.session
+
+
+def response_html(r: 'requests.Response') -> str | bytes:
+    """
+    Page markup for BeautifulSoup. Without a charset in Content-Type, requests
+    falls back to ISO-8859-1 for text/html, which garbles Japanese; hand over the
+    raw bytes instead so BeautifulSoup detects the encoding (<meta charset> etc.).
+    """
+    if 'charset=' in r.headers.get('Content-Type', '').lower():
+        return r.text
+    return r.content
+
+
+def fetch(url: str, timeout: float = 30.0, delay: float = 0.0) -> str | bytes:
+    r = get_session().get(url, timeout=timeout)
+    r.raise_for_status()
+    if delay:
+        # be polite: per-session pause between requests
+        time.sleep(delay)
+    return response_html(r)
+
+
+# --- Planning ---
+
+def enumerate_partitions(html: str | bytes, search_url: str, field: str) -> list[dict]:
+    """
+    Build one partition per option of the `field` <select> in the search form.
+    Hidden inputs of the same form are carried over as fixed parameters.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    select = soup.find('select', attrs={'name': field})
+    if select is None:
+        names = sorted({s.get('name') for s in soup.find_all('select') if s.get('name')})
+        raise ValueError(f'No <select name="{field}"> in search form; available: {", ".join(names) or "none"}')
+
+    form = select.find_parent('form')
+    action = urljoin(search_url, form.get('action') or search_url) if form else search_url
+    fixed = {}
+    if form:
+        for inp in form.find_all('input', attrs={'type': 'hidden'}):
+            if inp.get('name') and inp.get('value'):
+                fixed[inp['name']] = inp['value']
+
+    partitions = []
+    seen = set()
+    for opt in select.find_all('option'):
+        value = (opt.get('value') or '').strip()
+        if not value or value in seen:
+            continue
+        seen.add(value)
+        partitions.append({
+            'value': value,
+            'label': opt.text.strip() or value,
+            'params': dict(fixed, **{field: value}),
+            'base_url': action,
+        })
+    return partitions
+
+
+def page_url(partition: dict, page: int) -> str:
+    parts = urlsplit(partition['base_url'])
+    params = dict(parse_qsl(parts.query), **partition['params'])
+    if page > 1:
+        params['page'] = str(page)
+    return canonicalize_url(parts._replace(query=urlencode(params)).geturl())
+
+
+def count_pages(soup: BeautifulSoup, partition: dict) -> int:
+    """
+    Highest page number linked from this page that belongs to the same partition.
+    Windowed pagers only link nearby pages, so crawl_partition re-checks every page.
+    """
+    base = canonicalize_url(page_url(partition, 1), drop_params=('page',))
+    last = 1
+    for a in soup.find_all('a', href=True):
+        full = urljoin(partition['base_url'], a['href'])
+        if canonicalize_url(full, drop_params=('page',)) != base:
+            continue
+        page = dict(parse_qsl(urlsplit(full).query)).get('page', '')
+        if page.isdigit():
+            last = max(last, int(page))
+    return last
+
+
+def parse_cards(soup: BeautifulSoup) -> list[dict]:
+    table_body = soup.select_one(CARD_TABLE_BODY_SELECTOR)
+    if not table_body:
+        return []
+    cards = []
+    for row in table_body.find_all('tr'):
+        card = parse_card_row(row)
+        if card:
+            cards.append(card)
+    return cards
+
+
+# --- Crawl ---
+
+def safe_name(value: str) -> str:
+    return re.sub(r'[^0-9A-Za-z_.-]+', '_', value).strip('_') or 'partition'
+
+
+def load_manifest(out_dir: str) -> dict:
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {'partitions': {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(out_dir: str, manifest: dict) -> None:
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def plan_partition(partition: dict, progress: Progress, delay: float) -> dict:
+    """Fetch page 1 to learn the page count. Returns the partition state for crawl_partition."""
+    soup = BeautifulSoup(fetch(page_url(partition, 1), delay=delay), 'html.parser')
+    pages = count_pages(soup, partition)
+    progress.add_total(pages)
+    cards = parse_cards(soup)
+    progress.page_done(partition['label'], 1, len(cards))
+    return {'partition': partition, 'pages': pages, 'cards': cards}
+
+
+def crawl_partition(state: dict, progress: Progress, delay: float) -> dict:
+    """
+    Crawl pages 2.. of a planned partition. The page count grows whenever a
+    page's pager links further than planned, and the crawl stops early at a
+    page without cards.
+    """
+    partition = state['partition']
+    planned = pages = state['pages']
+    urls = [page_url(partition, 1)]
+    page = 2
+    while page <= pages:
+        url = page_url(partition, page)
+        soup = BeautifulSoup(fetch(url, delay=delay), 'html.parser')
+        cards = parse_cards(soup)
+        if not cards:
+            print(f'{partition["label"]} p{page}: no cards, stopping')
+            progress.add_total(-(pages - page + 1))
+            break
+        urls.append(url)
+        progress.page_done(partition['label'], page, len(cards))
+        state['cards'].extend(cards)
+        linked = count_pages(soup, partition)
+        if linked > pages:
+            progress.add_total(linked - pages)
+            pages = linked
+        page += 1
+
+    state['pages'] = len(urls)
+    state['planned_pages'] = planned
+    if state['pages'] != planned:
+        print(f'{partition["label"]}: crawled {state["pages"]} page(s), planned {planned}')
+    state['urls'] = urls
+    return state
+
+
+def run_crawl(search_url: str, field: str, out_dir: str, workers: int = 4, only: list[str] | None = None,
+              force: bool = False, delay: float = 1.0, plan_only: bool = False) -> int:
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = load_manifest(out_dir)
+    partitions = enumerate_partitions(fetch(search_url), search_url, field)
+    print(f'{len(partitions)} partition(s) from <select name="{field}">')
+
+    if only:
+        wanted = set(only)
+        partitions = [p for p in partitions if p['value'] in wanted]
+        missing = wanted - {p['value'] for p in partitions}
+        if missing:
+            print('Unknown partition value(s):', ', '.join(sorted(missing)))
+            return 2
+    if not force and not only:
+        done = {v for v, info in manifest['partitions'].items() if info.get('complete')}
+        skipped = [p for p in partitions if p['value'] in done]
+        partitions = [p for p in partitions if p['value'] not in done]
+        if skipped:
+            print(f'Skipping {len(skipped)} completed partition(s) (use --force to re-crawl)')
+
+    progress = Progress()
+    lock = threading.Lock()
+    manifest.update({'search_url': search_url, 'field': field})
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        states = list(ex.map(lambda p: plan_partition(p, progress, delay), partitions))
+        print(f'Plan: {len(states)} partition(s), {progress.pages_total} page(s) in total')
+        if plan_only:
+            for s in states:
+                print(f"  {s['partition']['value']:>12}  {s['pages']:4} page(s)  {s['partition']['label']}")
+            return 0
+
+        def crawl_and_save(state):
+            state = crawl_partition(state, progress, delay)
+            p = state['partition']
+            filename = safe_name(p['value']) + '.json'
+            with open(os.path.join(out_dir, filename), 'w', encoding='utf-8') as f:
+                json.dump(state['cards'], f, ensure_ascii=False, indent=2)
+            with lock:
+                manifest['partitions'][p['value']] = {
+                    'label': p['label'],
+                    'file': filename,
+                    'pages': state['pages'],
+                    'planned_pages': state['planned_pages'],
+                    'cards': len(state['cards']),
+                    'urls': state['urls'],
+                    'complete': True,
+                    'crawled_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                }
+                save_manifest(out_dir, manifest)
+
+        for f in [ex.submit(crawl_and_save, s) for s in states]:
+            f.result()
+
+    print(f'Done: {progress.pages_done} page(s), {progress.cards} card(s)')
+    return 0
+
+
+def merge_partitions(out_dir: str, output_path: str) -> int:
+    """Combine partition files into one card array (scrape_ws_cards.py output format), deduplicated by card_no."""
+    manifest = load_manifest(out_dir)
+    merged = {}
+    anonymous = []
+    for value in sorted(manifest['partitions']):
+        info = manifest['partitions'][value]
+        with open(os.path.join(out_dir, info['file']), 'r', encoding='utf-8') as f:
+            for card in json.load(f):
+                if card.get('card_no'):
+                    merged.setdefault(card['card_no'], card)
+                else:
+                    anonymous.append(card)
+    cards = list(merged.values()) + anonymous
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(cards, f, ensure_ascii=False, indent=2)
+    print(f'Merged {len(manifest["partitions"])} partition(s), {len(cards)} card(s) into {output_path}')
+    return 0
+
+
+def main(argv=None):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    p = argparse.ArgumentParser(description='Crawl the card list partitioned by expansion')
+    p.add_argument('--search-url', default=SEARCH_PAGE_URL, help='Search form page')
+    p.add_argument('--field', default='expansion', help='Name of the <select> to partition by')
+    p.add_argument('--out-dir', default=os.path.join(script_dir, 'crawl'), help='Partition files and manifest')
+    p.add_argument('--workers', type=int, default=4, help='Parallel sessions')
+    p.add_argument('--delay', type=float, default=1.0, help='Seconds to wait after each request, per session')
+    p.add_argument('--only', action='append', help='Crawl (or re-crawl) only this partition value (repeatable)')
+    p.add_argument('--force', action='store_true', help='Re-crawl partitions already marked complete')
+    p.add_argument('--plan-only', action='store_true', help='Print partitions and page counts without crawling')
+    p.add_argument('--merge', metavar='OUTPUT', help='Merge crawled partitions into one JSON file and exit')
+    args = p.parse_args(argv)
+
+    if args.merge:
+        return merge_partitions(args.out_dir, args.merge)
+
+    if requests is None:
+        print('requests is required for crawling (`pip install requests`)')
+        return 2
+
+    try:
+        return run_crawl(args.search_url, args.field, args.out_dir, workers=args.workers, only=args.only,
+                         force=args.force, delay=args.delay, plan_only=args.plan_only)
+    except (ValueError, requests.RequestException) as e:
+        print('Crawl failed:', e)
+        return 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
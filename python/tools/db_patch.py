@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+db_patch.py
+
+Delta patches between two builds of ws_cards.db, so a data refresh ships
+only what changed instead of the whole card JSON.
+
+Features:
+- `diff` compares two DBs by card_no and writes one gzip'd JSON patch with
+  inserts / updates (changed columns only) / deletes grouped by work_id
+- Every patch carries the catalogue checksum it applies to and the one it
+  produces, per-work checksums, and a SHA-256 over its own body
+- `apply` orders a set of patches into a chain starting from the DB's current
+  checksum and applies the whole chain in one transaction (rolled back on any
+  checksum mismatch)
+- `bench` builds synthetic catalogues and reports patch size and apply time
+
+Checksums cover content columns only (not id, timestamps or the client-local
+visual_* columns) and use decoded metadata, so they do not depend on the
+metadata storage mode (see metadata_codec.py). Applied rows store metadata as
+plain JSON. Per-work checksums are kept in the `patch_work_checksums` table of
+the patched DB, so applying a patch only rescans the works it touches.
+
+Usage:
+  python db_patch.py diff --old ws_cards.old.db --new ws_cards.db --out ws_cards.patch.gz
+  python db_patch.py apply --db ws_cards.db 1.patch.gz 2.patch.gz
+  python db_patch.py bench --sets 200 --cards 100
+"""
+from __future__ import annotations
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from import_to_sqlite import INSERT_SQL, create_schema, normalize_card
+from metadata_codec import SOURCE_COLUMNS, MetadataReader
+
+
+PATCH_FORMAT = 1
+
+# Columns that are not shipped: row identity/bookkeeping, client-local state and
+# enrich_details.py fetch state.
+LOCAL_COLUMNS = frozenset({
+    'id', 'created_at', 'updated_at', 'visual_local_path', 'visual_fetch_status',
+    'detail_etag', 'detail_last_modified', 'detail_status', 'detail_fetched_at',
+})
+
+CREATE_STATE_SQL = """
+CREATE TABLE IF NOT EXISTS patch_work_checksums(
+  work_id TEXT PRIMARY KEY,
+  checksum TEXT NOT NULL
+);
+"""
+
+
+class PatchError(Exception):
+    pass
+
+
+# --- Checksums ---
+
+def content_columns(conn: sqlite3.Connection) -> dict[str, str]:
+    """Shipped columns of `cards` mapped to their declared types, card_no first."""
+    cols = {}
+    for _, name, decl, *_ in conn.execute('PRAGMA table_info(cards)'):
+        if name not in LOCAL_COLUMNS:
+            cols[name] = decl
+    if 'card_no' not in cols:
+        raise PatchError('cards table has no card_no column')
+    return {'card_no': cols.pop('card_no'), **cols}
+
+
+def iter_rows(conn: sqlite3.Connection, columns, where: str = '', params=()):
+    """
+    Yield content rows as dicts, with metadata decoded to the original card dict.
+    Requested columns missing from this table come back as None.
+    """
+    present = {r[1] for r in conn.execute('PRAGMA table_info(cards)')}
+    select = list(dict.fromkeys([c for c in columns if c in present] + [c for c in SOURCE_COLUMNS if c in present]))
+    reader = MetadataReader(conn)
+    sql = f'SELECT {",".join(select)} FROM cards {where} ORDER BY card_no'
+    for values in conn.execute(sql, params):
+        row = dict(zip(select, values))
+        if row.get('metadata') is not None:
+            row['metadata'] = reader.decode(row)
+        yield {c: row.get(c) for c in columns}
+
+
+def row_hash(row: dict) -> str:
+    # NULLs are left out so adding an empty column does not change any checksum
+    canon = json.dumps({k: v for k, v in row.items() if v is not None}, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canon.encode('utf-8')).hexdigest()
+
+
+def work_checksum(hashes: dict[str, str]) -> str:
+    h = hashlib.sha256()
+    for card_no in sorted(hashes):
+        h.update(f'{card_no}\0{hashes[card_no]}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def catalogue_checksum(work_sums: dict[str, str]) -> str:
+    h = hashlib.sha256()
+    for work_id in sorted(work_sums):
+        h.update(f'{work_id}\0{work_sums[work_id]}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def scan_hashes(conn: sqlite3.Connection, columns, where: str = '', params=()) -> dict[str, dict[str, str]]:
+    """work_id -> {card_no: row hash}"""
+    works = defaultdict(dict)
+    for row in iter_rows(conn, columns, where, params):
+        works[row['work_id'] or ''][row['card_no']] = row_hash(row)
+    return works
+
+
+# --- Diff ---
+
+def diff_dbs(old_path: str, new_path: str) -> dict:
+    old = sqlite3.connect(old_path)
+    new = sqlite3.connect(new_path)
+    try:
+        columns = content_columns(new)
+        dropped = [c for c in content_columns(old) if c not in columns]
+        if dropped:
+            raise PatchError(f'new build drops column(s) {", ".join(dropped)}; ship a full import instead')
+
+        old_hashes = scan_hashes(old, columns)
+        new_hashes = scan_hashes(new, columns)
+
+        works = []
+        for work_id in sorted(set(old_hashes) | set(new_hashes)):
+            before = old_hashes.get(work_id, {})
+            after = new_hashes.get(work_id, {})
+            deletes = sorted(c for c in before if c not in after)
+            inserts, updates = [], []
+            for card_no in sorted(c for c in after if before.get(c) != after[c]):
+                new_row = next(iter_rows(new, columns, 'WHERE card_no = ?', (card_no,)))
+                if card_no not in before:
+                    inserts.append([new_row[c] for c in columns])
+                    continue
+                old_row = next(iter_rows(old, columns, 'WHERE card_no = ?', (card_no,)))
+                updates.append([card_no, {c: new_row[c] for c in columns if old_row[c] != new_row[c]}])
+            if not (deletes or inserts or updates):
+                continue
+            works.append({
+                'work_id': work_id,
+                'base': work_checksum(before) if before else None,
+                'target': work_checksum(after) if after else None,
+                'deletes': deletes,
+                'inserts': inserts,
+                'updates': updates,
+            })
+    finally:
+        old.close()
+        new.close()
+
+    return {
+        'format': PATCH_FORMAT,
+        'created_at': datetime.utcnow().isoformat(),
+        'base': catalogue_checksum({w: work_checksum(h) for w, h in old_hashes.items()}),
+        'target': catalogue_checksum({w: work_checksum(h) for w, h in new_hashes.items()}),
+        'columns': columns,
+        'works': works,
+    }
+
+
+def _body_sha256(body: dict) -> str:
+    canon = json.dumps(body, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canon.encode('utf-8')).hexdigest()
+
+
+def write_patch(body: dict, path: str) -> int:
+    doc = dict(body, sha256=_body_sha256(body))
+    data = json.dumps(doc, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    with gzip.open(path, 'wb', compresslevel=9) as f:
+        f.write(data)
+    return os.path.getsize(path)
+
+
+def read_patch(path: str) -> dict:
+    with gzip.open(path, 'rb') as f:
+        doc = json.loads(f.read().decode('utf-8'))
+    if doc.get('format') != PATCH_FORMAT:
+        raise PatchError(f'{path}: unsupported patch format {doc.get("format")!r}')
+    expected = doc.pop('sha256', None)
+    if expected != _body_sha256(doc):
+        raise PatchError(f'{path}: patch body checksum mismatch (corrupt download?)')
+    return doc
+
+
+# --- Apply ---
+
+def _load_state(conn: sqlite3.Connection, columns, rebuild: bool = False) -> dict[str, str]:
+    conn.execute(CREATE_STATE_SQL)
+    state = dict(conn.execute('SELECT work_id, checksum FROM patch_work_checksums'))
+    has_cards = conn.execute('SELECT 1 FROM cards LIMIT 1').fetchone() is not None
+    if rebuild or (not state and has_cards):
+        state = {w: work_checksum(h) for w, h in scan_hashes(conn, columns).items()}
+        conn.execute('DELETE FROM patch_work_checksums')
+        conn.executemany('INSERT INTO patch_work_checksums(work_id, checksum) VALUES(?, ?)', state.items())
+    return state
+
+
+def order_chain(patches: list[dict], current: str) -> tuple[list[dict], list[dict]]:
+    """Follow base -> target from `current`. Returns (chain, patches not on the chain)."""
+    by_base = {}
+    for p in patches:
+        if p['base'] in by_base and by_base[p['base']]['target'] != p['target']:
+            raise PatchError(f'two different patches start from checksum {p["base"][:12]}')
+        by_base[p['base']] = p
+    chain = []
+    seen = {current}
+    while current in by_base:
+        p = by_base.pop(current)
+        chain.append(p)
+        current = p['target']
+        if current in seen:
+            raise PatchError('patch chain contains a cycle')
+        seen.add(current)
+    return chain, list(by_base.values())
+
+
+def _storage_value(column: str, value):
+    if column == 'metadata' and value is not None:
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def _ensure_columns(conn: sqlite3.Connection, columns: dict[str, str]) -> None:
+    existing = {r[1] for r in conn.execute('PRAGMA table_info(cards)')}
+    for name, decl in columns.items():
+        if name not in existing:
+            conn.execute(f'ALTER TABLE cards ADD COLUMN {name} {decl}')
+
+
+def apply_patch(conn: sqlite3.Connection, patch: dict, state: dict[str, str], all_columns: list[str]) -> None:
+    columns = list(patch['columns'])
+    now = datetime.utcnow().isoformat()
+    insert_sql = (f'INSERT INTO cards({",".join(columns)},updated_at) VALUES({",".join("?" * (len(columns) + 1))}) '
+                  f'ON CONFLICT(card_no) DO UPDATE SET '
+                  + ','.join(f'{c}=excluded.{c}' for c in columns[1:]) + ',updated_at=excluded.updated_at')
+    for work in patch['works']:
+        work_id = work['work_id']
+        if state.get(work_id) != work['base']:
+            raise PatchError(f'work {work_id}: local data does not match patch base')
+        conn.executemany('DELETE FROM cards WHERE card_no = ?', [(c,) for c in work['deletes']])
+        conn.executemany(insert_sql, [
+            [_storage_value(c, v) for c, v in zip(columns, values)] + [now] for values in work['inserts']
+        ])
+        for card_no, delta in work['updates']:
+            sets = ','.join(f'{c} = ?' for c in delta)
+            params = [_storage_value(c, v) for c, v in delta.items()] + [now, card_no]
+            cur = conn.execute(f'UPDATE cards SET {sets}, updated_at = ? WHERE card_no = ?', params)
+            if cur.rowcount != 1:
+                raise PatchError(f'work {work_id}: card {card_no} to update is missing')
+
+        hashes = scan_hashes(conn, all_columns, 'WHERE work_id = ?', (work_id,)).get(work_id, {})
+        got = work_checksum(hashes) if hashes else None
+        if got != work['target']:
+            raise PatchError(f'work {work_id}: checksum after apply does not match patch target')
+        if got is None:
+            state.pop(work_id, None)
+            conn.execute('DELETE FROM patch_work_checksums WHERE work_id = ?', (work_id,))
+        else:
+            state[work_id] = got
+            conn.execute('INSERT OR REPLACE INTO patch_work_checksums(work_id, checksum) VALUES(?, ?)', (work_id, got))
+
+    if catalogue_checksum(state) != patch['target']:
+        raise PatchError('catalogue checksum after apply does not match patch target')
+
+
+def apply_patches(db_path: str, patch_paths: list[str], rebuild_state: bool = False) -> dict:
+    patches = [read_patch(p) for p in patch_paths]
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        create_schema(conn)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for p in patches:
+                _ensure_columns(conn, p['columns'])
+            all_columns = content_columns(conn)
+            state = _load_state(conn, list(all_columns), rebuild=rebuild_state)
+            current = catalogue_checksum(state)
+            chain, skipped = order_chain(patches, current)
+            if not chain and patches and current not in {p['target'] for p in patches}:
+                raise PatchError(f'no patch applies to the current catalogue ({current[:12]})')
+            for p in chain:
+                apply_patch(conn, p, state, list(all_columns))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
+    return {'applied': len(chain), 'skipped': len(skipped), 'checksum': catalogue_checksum(state)}
+
+
+# --- Bench ---
+
+def _synthetic_card(set_no: int, i: int, rev: int = 0) -> dict:
+    side = 'W' if set_no % 2 == 0 else 'S'
+    card_no = f'S{set_no:03d}/{side}{set_no % 100:02d}-{i:03d}'
+    return {
+        'detail_page_url': f'https://ws-tcg.com/cardlist/?cardno={card_no}&l',
+        'image_url': f'https://ws-tcg.com/wordpress/wp-content/images/cardlist/s/s{set_no:03d}/{i:03d}.png',
+        'name': f'カード{set_no}-{i}',
+        'card_no': card_no,
+        'サイド': 'ヴァイス' if side == 'W' else 'シュヴァルツ',
+        '種類': 'キャラ',
+        'レベル': str(i % 4),
+        '色': ('赤', '青', '黄', '緑')[i % 4],
+        'パワー': str(500 * (i % 20) + 500 * rev),
+        'ソウル': '',
+        'コスト': str(i % 3),
+        'レアリティ': ('C', 'U', 'R', 'RR')[i % 4],
+        'トリガー': '-',
+        '特徴': ['魔法'],
+        'flavor_text': 'まあ、ボクも長いこと学園にいるからさ。思い出がいっぱいになっちゃうんだよ',
+        'abilities': [f'【自】このカードがアタックした時、そのターン中、このカードのパワーを＋{500 * (1 + i % 4)}。'],
+    }
+
+
+def _build_db(path: str, cards: list[dict]) -> None:
+    conn = sqlite3.connect(path)
+    create_schema(conn)
+    conn.executemany(INSERT_SQL, [normalize_card(c) for c in cards])
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cards_work_id ON cards(work_id)')
+    conn.commit()
+    conn.close()
+
+
+def bench(sets: int, cards_per_set: int, new_sets: int = 1, updates: int = 5, deletes: int = 2, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    old_cards = [_synthetic_card(s, i) for s in range(sets) for i in range(cards_per_set)]
+    new_cards = {c['card_no']: c for c in old_cards}
+    for c in rng.sample(old_cards, min(updates, len(old_cards))):
+        new_cards[c['card_no']] = dict(c, パワー=str(int(c['パワー']) + 500))
+    for c in rng.sample(old_cards, min(deletes, len(old_cards))):
+        new_cards.pop(c['card_no'], None)
+    for s in range(sets, sets + new_sets):
+        for i in range(cards_per_set):
+            c = _synthetic_card(s, i)
+            new_cards[c['card_no']] = c
+
+    with tempfile.TemporaryDirectory() as tmp:
+        old_db, new_db, patch_path = (os.path.join(tmp, n) for n in ('old.db', 'new.db', 'p.patch.gz'))
+        _build_db(old_db, old_cards)
+        _build_db(new_db, list(new_cards.values()))
+        full_json = len(json.dumps(list(new_cards.values()), ensure_ascii=False, indent=2).encode('utf-8'))
+
+        t0 = time.perf_counter()
+        body = diff_dbs(old_db, new_db)
+        diff_s = time.perf_counter() - t0
+        patch_size = write_patch(body, patch_path)
+
+        # a client already holds per-work checksums from its previous update
+        conn = sqlite3.connect(old_db)
+        _load_state(conn, list(content_columns(conn)))
+        conn.commit()
+        conn.close()
+
+        t0 = time.perf_counter()
+        result = apply_patches(old_db, [patch_path])
+        apply_s = time.perf_counter() - t0
+
+        new_conn = sqlite3.connect(new_db)
+        expected = catalogue_checksum({w: work_checksum(h) for w, h in scan_hashes(new_conn, list(content_columns(new_conn))).items()})
+        new_conn.close()
+        if result['checksum'] != expected:
+            raise PatchError('bench: patched DB does not match the new build')
+
+    return {
+        'cards': len(new_cards),
+        'full_json_bytes': full_json,
+        'patch_bytes': patch_size,
+        'diff_seconds': diff_s,
+        'apply_seconds': apply_s,
+    }
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Create and apply delta patches between ws_cards.db builds')
+    sub = p.add_subparsers(dest='command', required=True)
+
+    d = sub.add_parser('diff', help='Write a patch turning --old into --new')
+    d.add_argument('--old', required=True, help='Previous DB build')
+    d.add_argument('--new', required=True, help='New DB build')
+    d.add_argument('--out', '-o', required=True, help='Output patch file (.patch.gz)')
+
+    a = sub.add_parser('apply', help='Apply a chain of patches to a DB in one transaction')
+    a.add_argument('--db', '-d', required=True, help='SQLite DB to patch')
+    a.add_argument('patches', nargs='+', help='Patch files, in any order')
+    a.add_argument('--rebuild-state', action='store_true', help='Recompute stored per-work checksums from the cards table')
+
+    b = sub.add_parser('bench', help='Measure patch size and apply time on synthetic catalogues')
+    b.add_argument('--sets', type=int, default=200, help='Sets in the old catalogue')
+    b.add_argument('--cards', type=int, default=100, help='Cards per set')
+    b.add_argument('--new-sets', type=int, default=1, help='Sets added in the new build')
+    b.add_argument('--updates', type=int, default=5, help='Cards changed in the new build')
+    b.add_argument('--deletes', type=int, default=2, help='Cards removed in the new build')
+    args = p.parse_args(argv)
+
+    if args.command == 'diff':
+        for path in (args.old, args.new):
+            if not os.path.exists(path):
+                print('DB file not found:', path)
+                return 2
+        body = diff_dbs(args.old, args.new)
+        size = write_patch(body, args.out)
+        counts = defaultdict(int)
+        for w in body['works']:
+            for k in ('inserts', 'updates', 'deletes'):
+                counts[k] += len(w[k])
+        print(f"Wrote {args.out} ({size:,} bytes): {len(body['works'])} work(s), "
+              f"{counts['inserts']} insert(s), {counts['updates']} update(s), {counts['deletes']} delete(s)")
+        return 0
+
+    if args.command == 'apply':
+        if not os.path.exists(args.db):
+            print('DB file not found:', args.db)
+            return 2
+        try:
+            result = apply_patches(args.db, args.patches, rebuild_state=args.rebuild_state)
+        except PatchError as e:
+            print('Patch failed, DB left unchanged:', e)
+            return 1
+        print(f"Applied {result['applied']} patch(es), skipped {result['skipped']}; catalogue checksum {result['checksum'][:12]}")
+        return 0
+
+    r = bench(args.sets, args.cards, new_sets=args.new_sets, updates=args.updates, deletes=args.deletes)
+    print(f"Catalogue: {r['cards']:,} cards, full JSON {r['full_json_bytes']:,} bytes")
+    print(f"Patch: {r['patch_bytes']:,} bytes ({r['patch_bytes'] / r['full_json_bytes']:.2%} of full JSON)")
+    print(f"Diff: {r['diff_seconds'] * 1000:.1f} ms, apply: {r['apply_seconds'] * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,34 +1,420 @@
 #!/usr/bin/env python3
-import sqlite3
+"""
+db_verify.py
+
+Rule-based data-quality validator for the `cards` table produced by
+import_to_sqlite.py.
+
+Features:
+- Rules are declared once with the @rule decorator and all run in a single pass
+- Streams the table in rowid-range chunks (no fetchall of the whole table)
+- Chunks are validated in parallel across a process pool, one read-only
+  connection per worker
+- Group rules (e.g. duplicate names per set) are aggregated across chunks
+- Emits a structured report (text or JSON) and exits non-zero on violations
+
+Usage:
+  python db_verify.py --db ws_cards.db
+  python db_verify.py --db ws_cards.db --format json --report report.json
+  python db_verify.py --db ws_cards.db --rule missing_side --rule missing_color
+  python db_verify.py --list-rules
+
+Exit status is 1 when a violation at or above --fail-on severity is found,
+2 when the DB cannot be opened, and 0 otherwise.
+"""
+from __future__ import annotations
+import argparse
 import json
-import sys
+import os
 import re
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from fix_ws_cards import COLOR_MAP, SIDE_MAP
+from import_to_sqlite import infer_work_id, safe_int
+from metadata_codec import SOURCE_COLUMNS, MetadataReader
+
+
+SEVERITIES = ('warning', 'error')
+
+# Columns handed to every rule as a dict (SOURCE_COLUMNS let compact metadata be rebuilt).
+ROW_COLUMNS = tuple(dict.fromkeys((
+    'rowid', 'card_no', 'name', 'work_id', 'side', 'color', 'type', 'level', 'power',
+    'cost', 'abilities_json', 'metadata', 'visual_local_path', 'visual_fetch_status',
+) + SOURCE_COLUMNS))
+
+VALID_SIDES = frozenset(SIDE_MAP.values())
+VALID_COLORS = frozenset(COLOR_MAP.values())
+
+# e.g. DC/W01-016, DC/W01-006R, BD/W63-T01, P3/S01-TE01SP
+CARD_NO_RE = re.compile(r'^[A-Za-z0-9]+/[A-Za-z0-9]+-[A-Za-z]*\d+[A-Za-z]*$')
+# Strip the trailing rarity suffix so parallel prints (006 / 006R) share a base number
+CARD_NO_BASE_RE = re.compile(r'^(.*-[A-Za-z]*\d+)')
+
+# Image paths are resolved against this directory in each worker.
+_image_root: str | None = None
+# Metadata accessor bound to the worker's current connection.
+_reader: MetadataReader | None = None
+
+
+class Rule:
+    def __init__(self, name: str, func, severity: str, description: str, group: bool):
+        self.name = name
+        self.func = func
+        self.severity = severity
+        self.description = description
+        self.group = group
+
+
+RULES: dict[str, Rule] = {}
+
+
+def rule(name: str, severity: str = 'error', group: bool = False):
+    """
+    Register a validation rule.
+
+    Row rules take a row dict and return a message (or list of messages)
+    for each violation, or None. Group rules return a hashable key (or None);
+    every key seen on more than one row is reported once the whole table
+    has been scanned.
+    """
+    if severity not in SEVERITIES:
+        raise ValueError(f'Unknown severity: {severity}')
+
+    def decorator(func):
+        doc = (func.__doc__ or '').strip().splitlines()
+        RULES[name] = Rule(name, func, severity, doc[0] if doc else '', group)
+        return func
+    return decorator
+
+
+def load_metadata(row: dict) -> dict:
+    if not row.get('metadata') or _reader is None:
+        return {}
+    try:
+        data = _reader.decode(row)
+    except (TypeError, ValueError, KeyError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _raw_value(meta: dict, jp_key: str, en_key: str):
+    v = meta.get(jp_key) or meta.get(en_key)
+    if v is None:
+        return None
+    s = str(v).strip()
+    if s == '' or s == '-':
+        return None
+    return s
+
+
+# --- Rules ---
+
+@rule('missing_side')
+def check_side(row):
+    """サイド is empty or not one of the known sides."""
+    side = row['side'] or ''
+    if side not in VALID_SIDES:
+        return f'side={side!r}'
+    return None
+
+
+@rule('missing_color')
+def check_color(row):
+    """色 is empty or not one of the known colors."""
+    color = row['color'] or ''
+    if color not in VALID_COLORS:
+        return f'color={color!r}'
+    return None
+
+
+@rule('unparsable_level')
+def check_level(row):
+    """レベル was present in the source but safe_int could not parse it."""
+    raw = _raw_value(load_metadata(row), 'レベル', 'level')
+    if raw is not None and safe_int(raw) is None:
+        return f'level={raw!r}'
+    return None
+
+
+@rule('unparsable_power')
+def check_power(row):
+    """パワー was present in the source but safe_int could not parse it."""
+    raw = _raw_value(load_metadata(row), 'パワー', 'power')
+    if raw is not None and safe_int(raw) is None:
+        return f'power={raw!r}'
+    return None
+
+
+@rule('malformed_card_no')
+def check_card_no(row):
+    """card_no does not look like SET/XNN-NNN or disagrees with work_id."""
+    card_no = row['card_no'] or ''
+    problems = []
+    if not CARD_NO_RE.match(card_no):
+        problems.append(f'card_no={card_no!r} is malformed')
+    expected = infer_work_id(card_no)
+    if row['work_id'] != expected:
+        problems.append(f'work_id={row["work_id"]!r} expected {expected!r}')
+    return problems
+
+
+@rule('orphan_image_path')
+def check_image_path(row):
+    """visual_local_path is set but the file does not exist."""
+    path = row['visual_local_path']
+    if not path:
+        return None
+    if _image_root and not os.path.isabs(path):
+        path = os.path.join(_image_root, path)
+    if not os.path.exists(path):
+        return f'visual_local_path={row["visual_local_path"]!r} not found'
+    return None
+
+
+@rule('bad_abilities_json')
+def check_abilities(row):
+    """abilities_json is not a JSON list of strings."""
+    try:
+        abilities = json.loads(row['abilities_json'] or '[]')
+    except ValueError as e:
+        return f'abilities_json unparsable: {e}'
+    if not isinstance(abilities, list) or not all(isinstance(a, str) for a in abilities):
+        return 'abilities_json is not a list of strings'
+    return None
+
+
+@rule('activate_cost_missing', severity='warning')
+def check_activate_cost(row):
+    """An 【起】 ability has no cost between 】 and its description."""
+    try:
+        abilities = json.loads(row['abilities_json'] or '[]')
+    except ValueError:
+        return None  # reported by bad_abilities_json
+    problems = []
+    for text in abilities:
+        if isinstance(text, str) and text.startswith('【起】'):
+            m = re.search(r'】(.*?)(「|$)', text)
+            if not m or not m.group(1).strip():
+                problems.append(f'no cost in {text[:40]!r}')
+    return problems
+
+
+@rule('duplicate_name_in_set', severity='warning', group=True)
+def key_duplicate_name(row):
+    """The same name appears under more than one card number in a set."""
+    if not row['name'] or not row['work_id']:
+        return None
+    return (row['work_id'], row['name'])
+
+
+# --- Runner ---
+
+def _violation(r: Rule, row: dict, message: str) -> dict:
+    return {
+        'rule': r.name,
+        'severity': r.severity,
+        'rowid': row['rowid'],
+        'card_no': row['card_no'],
+        'message': message,
+    }
+
+
+def _init_worker(image_root: str | None) -> None:
+    global _image_root
+    _image_root = image_root
+
+
+def connect_readonly(db_path: str) -> sqlite3.Connection:
+    uri = 'file:' + os.path.abspath(db_path).replace('\\', '/') + '?mode=ro'
+    return sqlite3.connect(uri, uri=True)
+
+
+def validate_chunk(db_path: str, lo: int, hi: int, rule_names: list[str]) -> dict:
+    """
+    Validate rows with lo <= rowid < hi. Runs inside a pool worker.
+
+    Returns row violations plus, for each group rule, a mapping of
+    key -> [(rowid, card_no), ...] for merging in the parent.
+    """
+    global _reader
+    row_rules = [RULES[n] for n in rule_names if not RULES[n].group]
+    group_rules = [RULES[n] for n in rule_names if RULES[n].group]
+    violations = []
+    groups = {r.name: defaultdict(list) for r in group_rules}
+    scanned = 0
+
+    conn = connect_readonly(db_path)
+    _reader = MetadataReader(conn)
+    try:
+        cur = conn.execute(
+            f'SELECT {",".join(ROW_COLUMNS)} FROM cards WHERE rowid >= ? AND rowid < ? ORDER BY rowid',
+            (lo, hi),
+        )
+        for values in cur:
+            row = dict(zip(ROW_COLUMNS, values))
+            scanned += 1
+            for r in row_rules:
+                result = r.func(row)
+                if not result:
+                    continue
+                if isinstance(result, str):
+                    result = [result]
+                for message in result:
+                    violations.append(_violation(r, row, message))
+            for r in group_rules:
+                key = r.func(row)
+                if key is not None:
+                    groups[r.name][key].append((row['rowid'], row['card_no']))
+    finally:
+        _reader = None
+        conn.close()
+
+    return {'scanned': scanned, 'violations': violations, 'groups': {k: dict(v) for k, v in groups.items()}}
+
+
+def rowid_chunks(conn: sqlite3.Connection, chunk_size: int) -> list[tuple[int, int]]:
+    lo, hi = conn.execute('SELECT MIN(rowid), MAX(rowid) FROM cards').fetchone()
+    if lo is None:
+        return []
+    return [(start, min(start + chunk_size, hi + 1)) for start in range(lo, hi + 1, chunk_size)]
+
+
+def base_card_no(card_no: str | None) -> str | None:
+    m = CARD_NO_BASE_RE.match(card_no or '')
+    return m.group(1) if m else card_no
+
+
+def _merge_groups(group_rule: Rule, merged: dict) -> list[dict]:
+    violations = []
+    for key, members in merged.items():
+        bases = {base_card_no(c) for _, c in members}
+        if len(bases) < 2:
+            continue
+        members.sort()
+        rowid, card_no = members[0]
+        others = ', '.join(c or '?' for _, c in members[1:])
+        violations.append(_violation(
+            group_rule, {'rowid': rowid, 'card_no': card_no},
+            f'{"/".join(str(k) for k in key)} also used by {others}',
+        ))
+    return violations
+
+
+def run(db_path: str, rule_names: list[str], chunk_size: int = 5000, workers: int | None = None,
+        image_root: str | None = None) -> dict:
+    conn = connect_readonly(db_path)
+    try:
+        chunks = rowid_chunks(conn, chunk_size)
+    finally:
+        conn.close()
+
+    scanned = 0
+    violations = []
+    merged: dict[str, dict] = {n: defaultdict(list) for n in rule_names if RULES[n].group}
+
+    def consume(result):
+        nonlocal scanned
+        scanned += result['scanned']
+        violations.extend(result['violations'])
+        for name, keys in result['groups'].items():
+            for key, members in keys.items():
+                merged[name][key].extend(members)
+
+    if workers == 1 or len(chunks) <= 1:
+        _init_worker(image_root)
+        for lo, hi in chunks:
+            consume(validate_chunk(db_path, lo, hi, rule_names))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(image_root,)) as ex:
+            futures = [ex.submit(validate_chunk, db_path, lo, hi, rule_names) for lo, hi in chunks]
+            for f in futures:
+                consume(f.result())
+
+    for name, keys in merged.items():
+        violations.extend(_merge_groups(RULES[name], keys))
+
+    violations.sort(key=lambda v: (v['rule'], v['rowid']))
+    summary = {}
+    for name in rule_names:
+        summary[name] = {'severity': RULES[name].severity, 'violations': 0}
+    for v in violations:
+        summary[v['rule']]['violations'] += 1
+
+    return {
+        'db': db_path,
+        'rows_scanned': scanned,
+        'chunks': len(chunks),
+        'summary': summary,
+        'violations': violations,
+    }
+
+
+def format_text(report: dict, limit: int = 20) -> str:
+    lines = [f"Scanned {report['rows_scanned']} rows in {report['chunks']} chunks: {report['db']}", '']
+    by_rule = defaultdict(list)
+    for v in report['violations']:
+        by_rule[v['rule']].append(v)
+    for name, info in report['summary'].items():
+        lines.append(f"[{info['severity']}] {name}: {info['violations']} violation(s)")
+        for v in by_rule[name][:limit]:
+            lines.append(f"    rowid={v['rowid']} {v['card_no']}: {v['message']}")
+        if len(by_rule[name]) > limit:
+            lines.append(f"    ... {len(by_rule[name]) - limit} more")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    default_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ws_cards.db')
+    p = argparse.ArgumentParser(description='Validate data quality of the cards table')
+    p.add_argument('--db', '-d', default=default_db, help='SQLite DB path')
+    p.add_argument('--rule', action='append', dest='rules', help='Run only this rule (repeatable)')
+    p.add_argument('--skip', action='append', default=[], help='Skip this rule (repeatable)')
+    p.add_argument('--chunk', type=int, default=5000, help='Rows (rowid span) per chunk')
+    p.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    p.add_argument('--image-root', default=None, help='Directory relative visual_local_path values are resolved against')
+    p.add_argument('--format', choices=('text', 'json'), default='text', help='Report format')
+    p.add_argument('--report', default=None, help='Write the report to this file instead of stdout')
+    p.add_argument('--fail-on', choices=SEVERITIES, default='error', help='Lowest severity that causes a non-zero exit')
+    p.add_argument('--list-rules', action='store_true', help='List available rules and exit')
+    args = p.parse_args(argv)
+
+    if args.list_rules:
+        for r in RULES.values():
+            print(f'{r.name:24} [{r.severity}] {r.description}')
+        return 0
+
+    names = args.rules or list(RULES)
+    unknown = [n for n in names + args.skip if n not in RULES]
+    if unknown:
+        print('Unknown rule(s):', ', '.join(unknown))
+        return 2
+    names = [n for n in names if n not in args.skip]
+
+    if not os.path.exists(args.db):
+        print('DB file not found:', args.db)
+        return 2
+
+    try:
+        report = run(args.db, names, chunk_size=args.chunk, workers=args.workers, image_root=args.image_root)
+    except sqlite3.DatabaseError as e:
+        # not a SQLite file (e.g. an LFS pointer) or no cards table
+        print(f'Cannot read DB {args.db}: {e}')
+        return 2
+
+    out = json.dumps(report, ensure_ascii=False, indent=2) if args.format == 'json' else format_text(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            f.write(out)
+        print('Report written to:', args.report)
+    else:
+        print(out)
+
+    threshold = SEVERITIES.index(args.fail_on)
+    failing = sum(1 for v in report['violations'] if SEVERITIES.index(v['severity']) >= threshold)
+    return 1 if failing else 0
+
 
-db_path = 'python/tools/ws_cards.db'
-conn = sqlite3.connect(db_path)
-cur = conn.cursor()
-
-try:
-    cur.execute("SELECT abilities_json FROM cards")
-    rows = cur.fetchall()
-    
-    unique_costs = set()
-    
-    for row in rows:
-        abilities = json.loads(row[0])
-        for ability_text in abilities:
-            if ability_text.startswith('【起】'):
-                # Extract the cost part, which is between '】' and the description starting with '「' or the end of the string
-                match = re.search(r'】(.*?)(「|$)', ability_text)
-                if match:
-                    cost_string = match.group(1).strip()
-                    if cost_string:
-                        unique_costs.add(cost_string)
-
-    print("--- Unique Activate Ability Costs ---")
-    for cost in sorted(list(unique_costs)):
-        print(cost)
-    print("------------------------------------")
-
-finally:
-    conn.close()
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+enrich_details.py
+
+Fill card fields the search-result list leaves blank by fetching each
+card's `detail_page_url`.
+
+Features:
+- Driven by the SQLite `cards` table (rows never fetched or re-imported since
+  their last fetch, or all with --refresh)
+- Bounded concurrent fetch pool, one requests.Session per worker thread
+- Conditional requests (ETag / Last-Modified stored per card); 304 responses
+  skip parsing
+- Only 200/304/404 mark a card as fetched; transient errors (429, 5xx,
+  network) and pages with an icon the cache cannot decode are retried by the
+  next plain run
+- Values parsed from a 200 replace the stored ones for the fields the detail
+  page carries (so --refresh picks up changed pages), and are written through
+  import_to_sqlite.normalize_card so columns stay consistent with a fresh
+  import; metadata is rewritten in the row's storage mode
+- New columns: soul, illustrator, product_name (plus detail_* fetch state)
+- Icon URL -> value mappings (サイド/色/ソウル/トリガー icons) are decoded once
+  and cached in the `icon_values` table; rows there with a value take
+  precedence, so unknown icons can be mapped by hand. Both detail-page icons
+  and the list-view `ソウル_img` / `トリガー_img` (and サイド/色) URLs already
+  stored on the card go through the cache; the stored ones only fill what the
+  detail page left blank, and only once the card is settled (200/304/404)
+- Results are written back in batched transactions
+
+Usage:
+  python enrich_details.py --db ws_cards.db
+  python enrich_details.py --db ws_cards.db --refresh --workers 8
+  python enrich_details.py --db ws_cards.db --base-url http://127.0.0.1:8000   # local fixture server
+
+Requires `requests` and `beautifulsoup4`.
+"""
+from __future__ import annotations
+import argparse
+import os
+import sqlite3
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from urllib.parse import urljoin, urlsplit
+
+from bs4 import BeautifulSoup
+
+from crawl_planner import get_session, response_html
+from fix_ws_cards import COLOR_MAP, SIDE_MAP
+from import_to_sqlite import INSERT_COLUMNS, normalize_card, safe_int
+from metadata_codec import SOURCE_COLUMNS, MetadataReader, reencode_metadata
+
+try:
+    import requests
+except Exception:
+    requests = None
+
+
+# Added to `cards` on first run.
+ENRICH_COLUMNS = {
+    'soul': 'INTEGER',
+    'illustrator': 'TEXT',
+    'product_name': 'TEXT',
+    'detail_etag': 'TEXT',
+    'detail_last_modified': 'TEXT',
+    'detail_status': 'INTEGER',
+    'detail_fetched_at': 'TEXT',
+}
+
+# Responses that settle a card: stamped with detail_fetched_at. Anything else
+# (429, 5xx, network errors) only records detail_status and is retried next run.
+FINAL_STATUSES = (200, 304, 404)
+
+CREATE_ICONS_SQL = """
+CREATE TABLE IF NOT EXISTS icon_values(
+  url TEXT PRIMARY KEY,
+  value TEXT
+);
+"""
+
+# Detail table label -> raw card key (same keys as scrape_ws_cards.py output).
+TEXT_FIELDS = {
+    '種類': '種類',
+    'レベル': 'レベル',
+    'コスト': 'コスト',
+    'パワー': 'パワー',
+    'レアリティ': 'レアリティ',
+    'イラスト': 'イラスト',
+    '商品名': '商品名',
+}
+ICON_FIELDS = ('サイド', '色', 'ソウル', 'トリガー')
+
+# Icon file name (without extension) -> value.
+ICON_FILE_VALUES = {
+    **{letter.lower(): name for letter, name in SIDE_MAP.items()},
+    **COLOR_MAP,
+    'soul': 'ソウル',
+    'salvage': 'カムバック',
+    'comeback': 'カムバック',
+    'draw': 'ドロー',
+    'stock': 'プール',
+    'pool': 'プール',
+    'bounce': 'リターン',
+    'return': 'リターン',
+    'shot': 'ショット',
+    'gate': 'ゲート',
+    'choice': 'チョイス',
+    'treasure': 'トレジャー',
+    'standby': 'スタンバイ',
+}
+
+
+class IconCache:
+    """Thread-safe icon URL -> value cache backed by the icon_values table."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        conn.execute(CREATE_ICONS_SQL)
+        self.lock = threading.Lock()
+        self.values = dict(conn.execute('SELECT url, value FROM icon_values'))
+        self.new = {}
+        self.unknown = set()
+
+    def decode(self, url: str) -> str | None:
+        with self.lock:
+            if url in self.values:
+                if self.values[url] is None:
+                    self.unknown.add(url)
+                return self.values[url]
+            name = os.path.splitext(os.path.basename(urlsplit(url).path))[0].lower()
+            value = ICON_FILE_VALUES.get(name)
+            if value is None:
+                self.unknown.add(url)
+            self.values[url] = self.new[url] = value
+            return value
+
+    def flush(self, conn: sqlite3.Connection) -> None:
+        with self.lock:
+            pending, self.new = self.new, {}
+        conn.executemany('INSERT OR IGNORE INTO icon_values(url, value) VALUES(?, ?)', pending.items())
+
+
+def parse_detail_page(html: str | bytes, page_url: str, icons: IconCache) -> tuple[dict, list]:
+    """
+    Extract raw card fields from a detail page's label/value table rows.
+    Icon cells are decoded through `icons`; ソウル is the number of soul icons.
+    Returns (fields, unresolved): icon cells holding an icon the cache cannot
+    decode yield no field and their label is listed in `unresolved`.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    fields = {}
+    unresolved = []
+    for tr in soup.find_all('tr'):
+        th, td = tr.find('th'), tr.find('td')
+        if not th or not td:
+            continue
+        label = th.get_text(strip=True)
+
+        if label in ICON_FIELDS:
+            decoded = [icons.decode(urljoin(page_url, img['src'])) for img in td.find_all('img', src=True)]
+            text = td.get_text(strip=True)
+            if None in decoded:
+                unresolved.append(label)
+            elif label == 'ソウル':
+                if decoded:
+                    fields['ソウル'] = str(sum(1 for v in decoded if v == 'ソウル'))
+                elif text and text != '-':
+                    fields['ソウル'] = text
+            elif decoded:
+                fields[label] = ' '.join(decoded) if label == 'トリガー' else decoded[0]
+            elif text:
+                fields[label] = text
+            elif label == 'トリガー' and not decoded:
+                fields['トリガー'] = '-'
+        elif label in TEXT_FIELDS:
+            text = td.get_text(strip=True)
+            if text:
+                fields[TEXT_FIELDS[label]] = text
+        elif label == '特徴':
+            traits = [s.get_text(strip=True) for s in td.find_all('span')] or [td.get_text(strip=True)]
+            traits = [t for t in traits if t and t != '-']
+            if traits:
+                fields['特徴'] = traits
+        elif label == 'フレーバー':
+            text = td.get_text(strip=True)
+            if text and text != '-':
+                fields['フレーバー'] = fields['flavor_text'] = text
+        elif label == 'テキスト':
+            for br in td.find_all('br'):
+                br.replace_with('|||')
+            abilities = [a.strip() for a in td.get_text(strip=True).split('|||') if a.strip()]
+            if abilities:
+                fields['abilities'] = abilities
+    return fields, unresolved
+
+
+def fill_blanks(card: dict, fields: dict) -> dict:
+    """Copy parsed fields into a copy of `card` where the card has no value yet."""
+    merged = dict(card)
+    for key, value in fields.items():
+        if merged.get(key) in (None, '', []):
+            merged[key] = value
+    return merged
+
+
+# --- Fetch ---
+
+def fetch_detail(job: dict, base_url: str | None, icons: IconCache, timeout: float) -> dict:
+    """Runs in a worker thread. Returns a result dict for the writer."""
+    url = job['url']
+    if base_url:
+        parts = urlsplit(url)
+        url = urljoin(base_url.rstrip('/') + '/', parts.path.lstrip('/') + (f'?{parts.query}' if parts.query else ''))
+    headers = {}
+    if job['etag']:
+        headers['If-None-Match'] = job['etag']
+    if job['last_modified']:
+        headers['If-Modified-Since'] = job['last_modified']
+
+    result = {'id': job['id'], 'status': None, 'etag': job['etag'], 'last_modified': job['last_modified'],
+              'fields': None, 'final': False}
+    try:
+        r = get_session().get(url, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        result['error'] = str(e)
+        return result
+    result['status'] = r.status_code
+    result['final'] = r.status_code in FINAL_STATUSES
+    if r.status_code == 200:
+        # icon URLs resolve against the canonical page URL so cache keys do not depend on --base-url
+        fields, unresolved = parse_detail_page(response_html(r), job['url'], icons)
+        if fields:
+            result['fields'] = fields
+            result['etag'] = r.headers.get('ETag')
+            result['last_modified'] = r.headers.get('Last-Modified')
+        if fields and unresolved:
+            # keep the card in the work set, without validators, until the icon is mapped in icon_values
+            result.update(error='unknown icon(s): ' + ', '.join(unresolved), final=False, etag=None, last_modified=None)
+        elif not fields:
+            # unparsable page: keep no validators so the next run fetches it again in full
+            result.update(error='no fields parsed', final=False, etag=None, last_modified=None)
+    return result
+
+
+# --- Write back ---
+
+def ensure_schema(conn: sqlite3.Connection) -> None:
+    existing = {r[1] for r in conn.execute('PRAGMA table_info(cards)')}
+    for name, decl in ENRICH_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f'ALTER TABLE cards ADD COLUMN {name} {decl}')
+    conn.commit()
+
+
+def stored_icon_fields(card: dict, icons: IconCache) -> dict:
+    """
+    Resolve the list-view icon URLs scrape_ws_cards.py stores as `<key>_img`.
+    The list view keeps only the first icon of a cell, so these are used only
+    where the detail page gave no value (one soul icon counts as ソウル 1).
+    """
+    fields = {}
+    for key in ('サイド', '色', 'トリガー'):
+        url = card.get(key + '_img')
+        value = icons.decode(url) if url else None
+        if value:
+            fields[key] = value
+    url = card.get('ソウル_img')
+    value = icons.decode(url) if url else None
+    if value == 'ソウル':
+        fields['ソウル'] = '1'
+    elif value and value.isdigit():
+        # hand-mapped count icons in icon_values
+        fields['ソウル'] = value
+    return fields
+
+
+def apply_result(conn: sqlite3.Connection, reader: MetadataReader, encoders: dict, icons: IconCache, result: dict) -> bool:
+    """
+    Write one fetch result. Fields parsed from a 200 replace the stored values.
+    Stored icon URLs only fill blanks on final results (200/304/404): the list
+    view keeps just the first icon, so they must not settle a retried card.
+    Returns True if card data changed.
+    """
+    cols = ('metadata',) + SOURCE_COLUMNS
+    found = conn.execute(f'SELECT {",".join(cols)} FROM cards WHERE id = ?', (result['id'],)).fetchone()
+    row = dict(zip(cols, found))
+    card = reader.decode(row)
+
+    # the detail page is authoritative for the fields it carries, so a changed page (new ETag) wins
+    merged = {**card, **(result['fields'] or {})}
+    if result['final']:
+        merged = fill_blanks(merged, stored_icon_fields(card, icons))
+    changed = merged != card
+
+    # updated_at and detail_fetched_at share one timestamp so the row does not look re-imported
+    now = datetime.utcnow().isoformat()
+    updates = {}
+    if result['status'] is not None:
+        # only final outcomes are stamped as fetched; others stay in the default work set
+        updates.update({
+            'detail_status': result['status'],
+            'detail_etag': result['etag'],
+            'detail_last_modified': result['last_modified'],
+            'detail_fetched_at': now if result['final'] else None,
+        })
+    if changed or result['fields'] is not None:
+        updates.update({
+            'soul': safe_int(merged.get('ソウル')),
+            'illustrator': merged.get('イラスト'),
+            'product_name': merged.get('商品名'),
+        })
+    if changed:
+        values = dict(zip(INSERT_COLUMNS, normalize_card(merged)))
+        for col in INSERT_COLUMNS:
+            if col not in ('card_no', 'metadata'):
+                updates[col] = values[col]
+        updates['updated_at'] = now
+        columns_after = {c: updates.get(c, row.get(c)) for c in SOURCE_COLUMNS}
+        updates['metadata'] = reencode_metadata(conn, row['metadata'], merged, columns_after, encoders)
+
+    if updates:
+        sets = ', '.join(f'{c} = ?' for c in updates)
+        conn.execute(f'UPDATE cards SET {sets} WHERE id = ?', list(updates.values()) + [result['id']])
+    return changed
+
+
+def enrich(db_path: str, workers: int = 4, batch_size: int = 200, refresh: bool = False, limit: int | None = None,
+           base_url: str | None = None, timeout: float = 30.0) -> dict:
+    conn = sqlite3.connect(db_path)
+    ensure_schema(conn)
+    icons = IconCache(conn)
+    reader = MetadataReader(conn)
+    encoders = {}
+
+    # a re-import (import_to_sqlite.py upsert) rewrites the row and its updated_at, dropping
+    # enriched values: such rows are fetched again, without validators so the page is parsed
+    stale = 'updated_at > detail_fetched_at'
+    where = "detail_page_url IS NOT NULL AND detail_page_url != ''"
+    if not refresh:
+        where += f' AND (detail_fetched_at IS NULL OR {stale})'
+    sql = (f'SELECT id, detail_page_url, detail_etag, detail_last_modified, coalesce({stale}, 0) '
+           f'FROM cards WHERE {where} ORDER BY id')
+    if limit:
+        sql += f' LIMIT {int(limit)}'
+    jobs = [{'id': i, 'url': u, 'etag': None if reimported else e, 'last_modified': None if reimported else lm}
+            for i, u, e, lm, reimported in conn.execute(sql)]
+    total = len(jobs)
+    print(f'{total} card(s) to fetch')
+
+    stats = {'fetched': 0, 'not_modified': 0, 'changed': 0, 'errors': 0}
+    done = 0
+    pending_writes = 0
+
+    def write(result):
+        nonlocal done, pending_writes
+        done += 1
+        if result.get('error') or (result['status'] not in (200, 304)):
+            stats['errors'] += 1
+            print(f"[{done}/{total}] id={result['id']}: {result['status'] or ''} {result.get('error') or ''}".rstrip())
+        elif result['status'] == 304:
+            stats['not_modified'] += 1
+        else:
+            stats['fetched'] += 1
+        if apply_result(conn, reader, encoders, icons, result):
+            stats['changed'] += 1
+        pending_writes += 1
+        if pending_writes >= batch_size:
+            commit()
+
+    def commit():
+        nonlocal pending_writes
+        icons.flush(conn)
+        conn.commit()
+        pending_writes = 0
+        print(f'[{done}/{total}] committed ({stats["changed"]} changed, {stats["not_modified"]} not modified, {stats["errors"]} errors)')
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            # keep a bounded window of in-flight requests instead of queueing every job
+            it = iter(jobs)
+            in_flight = set()
+            for job in it:
+                in_flight.add(ex.submit(fetch_detail, job, base_url, icons, timeout))
+                if len(in_flight) >= workers * 2:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for f in finished:
+                        write(f.result())
+            for f in in_flight:
+                write(f.result())
+    finally:
+        commit()
+        conn.close()
+
+    stats['unknown_icons'] = sorted(icons.unknown)
+    return stats
+
+
+def main(argv=None):
+    default_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ws_cards.db')
+    p = argparse.ArgumentParser(description='Enrich cards from their detail pages')
+    p.add_argument('--db', '-d', default=default_db, help='SQLite DB path')
+    p.add_argument('--workers', type=int, default=4, help='Concurrent requests')
+    p.add_argument('--batch', type=int, default=200, help='Results per write transaction')
+    p.add_argument('--refresh', action='store_true', help='Revalidate already fetched cards (conditional requests)')
+    p.add_argument('--limit', type=int, default=None, help='Max cards to fetch (for testing)')
+    p.add_argument('--base-url', default=None, help='Fetch from this origin instead (e.g. a local fixture server)')
+    p.add_argument('--timeout', type=float, default=30.0, help='Per-request timeout in seconds')
+    args = p.parse_args(argv)
+
+    if requests is None:
+        print('requests is required (`pip install requests`)')
+        return 2
+    if not os.path.exists(args.db):
+        print('DB file not found:', args.db)
+        return 2
+
+    stats = enrich(args.db, workers=args.workers, batch_size=args.batch, refresh=args.refresh, limit=args.limit,
+                   base_url=args.base_url, timeout=args.timeout)
+    print(f"Done: {stats['fetched']} fetched, {stats['not_modified']} not modified, "
+          f"{stats['changed']} changed, {stats['errors']} error(s)")
+    if stats['unknown_icons']:
+        print('Unknown icons (map them in the icon_values table):')
+        for url in stats['unknown_icons']:
+            print('  ' + url)
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -10,9 +10,13 @@ Features:
 - Basic normalization (level/power/cost -> ints or NULL)
 - Infer work_id from card_no
 - Create indexes after import (configurable)
+- Optional compact metadata storage (--metadata-mode residual): only fields not
+  already mapped to columns are kept, compressed with a shared dictionary
+  (see metadata_codec.py; read rows back with metadata_codec.MetadataReader)
 
 Usage:
   python import_to_sqlite.py --input weiss_schwarz_cards.fixed.json --db ws_cards.db
+  python import_to_sqlite.py --input weiss_schwarz_cards.fixed.json --db ws_cards.db --metadata-mode residual
 
 If ijson is not installed the script will fall back to a memory-load (not recommended for very large files).
 """
@@ -58,6 +62,13 @@ CREATE TABLE IF NOT EXISTS cards(
 );
 """
 
+# Column order of the tuples returned by normalize_card
+INSERT_COLUMNS = (
+  'card_no', 'name', 'work_id', 'detail_page_url', 'image_url', 'side', 'color', 'type', 'level', 'power', 'cost',
+  'rarity', 'trigger', 'flavor_text', 'abilities_json', 'traits_json', 'metadata', 'updated_at',
+)
+METADATA_INDEX = INSERT_COLUMNS.index('metadata')
+
 INSERT_SQL = """
 INSERT INTO cards(
   card_no,name,work_id,detail_page_url,image_url,side,color,type,level,power,cost,rarity,trigger,flavor_text,abilities_json,traits_json,metadata,updated_at
@@ -140,7 +151,8 @@ def normalize_card(card: dict) -> tuple:
     )
 
 
-def import_stream(input_path: str, db_path: str, batch_size: int = 1000, create_indexes: bool = True, max_rows: int | None = None):
+def import_stream(input_path: str, db_path: str, batch_size: int = 1000, create_indexes: bool = True, max_rows: int | None = None,
+                  metadata_mode: str = 'full', codec: str = 'auto'):
     if not os.path.exists(input_path):
         print('Input file not found:', input_path)
         return 2
@@ -152,24 +164,36 @@ def import_stream(input_path: str, db_path: str, batch_size: int = 1000, create_
 
     cur = conn.cursor()
 
+    encoder = None
+    if metadata_mode == 'residual':
+        from metadata_codec import MetadataEncoder
+        encoder = MetadataEncoder(conn, codec)
+        print('Metadata mode: residual, codec =', encoder.codec)
+
     batch = []
+    raw_cards = []
     total = 0
 
     def flush_batch():
-        nonlocal batch, total
+        nonlocal batch, raw_cards, total
         if not batch:
             return
+        if encoder:
+            batch = encoder.encode_rows(raw_cards, batch, METADATA_INDEX, INSERT_COLUMNS)
         cur.executemany(INSERT_SQL, batch)
         conn.commit()
         total += len(batch)
         print(f'Imported {total} rows...')
         batch = []
+        raw_cards = []
 
     if ijson:
         with open(input_path, 'rb') as f:
             items = ijson.items(f, 'item')
             for i, card in enumerate(items, start=1):
                 batch.append(normalize_card(card))
+                if encoder:
+                    raw_cards.append(card)
                 if len(batch) >= batch_size:
                     flush_batch()
                 if max_rows and i >= max_rows:
@@ -181,6 +205,8 @@ def import_stream(input_path: str, db_path: str, batch_size: int = 1000, create_
             cards = json.load(f)
             for i, card in enumerate(cards, start=1):
                 batch.append(normalize_card(card))
+                if encoder:
+                    raw_cards.append(card)
                 if len(batch) >= batch_size:
                     flush_batch()
                 if max_rows and i >= max_rows:
@@ -211,6 +237,10 @@ def main(argv=None):
     p.add_argument('--batch', type=int, default=1000, help='Batch size for inserts')
     p.add_argument('--no-index', dest='create_indexes', action='store_false', help='Do not create indexes after import')
     p.add_argument('--max', type=int, default=None, help='Max rows to import (for testing)')
+    p.add_argument('--metadata-mode', choices=('full', 'residual'), default='full',
+                   help='full: raw card JSON in metadata; residual: only unmapped fields, compressed')
+    p.add_argument('--codec', choices=('auto', 'zstd', 'zlib', 'none'), default='auto',
+                   help='Compression for --metadata-mode residual (auto: zstd if installed, else zlib)')
     args = p.parse_args(argv)
 
     if args.max:
@@ -219,7 +249,8 @@ def main(argv=None):
     if ijson is None:
         print('Warning: ijson not installed. For large files install ijson (`pip install ijson`)')
 
-    return import_stream(args.input, args.db, batch_size=args.batch, create_indexes=args.create_indexes, max_rows=args.max)
+    return import_stream(args.input, args.db, batch_size=args.batch, create_indexes=args.create_indexes, max_rows=args.max,
+                         metadata_mode=args.metadata_mode, codec=args.codec)
 
 
 if __name__ == '__main__':
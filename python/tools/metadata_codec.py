@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+metadata_codec.py
+
+Compact storage for the `cards.metadata` column.
+
+By default import_to_sqlite.py stores the whole raw card dict again in
+`metadata` as JSON, duplicating every mapped column. The "residual" mode
+implemented here instead keeps only:
+- keys that are not mapped to a column, and
+- mapped keys whose raw value cannot be rebuilt exactly from the column
+  (e.g. パワー '-' stored as NULL)
+plus a bitmask of the mapped keys that can be rebuilt (and, when it differs
+from rebuilt-keys-first, the original key order, so a decoded card dumps to
+the same JSON layout as full mode). The residual JSON is
+compressed with a dictionary trained on the first import batch and shared by
+all rows (zstd when `zstandard` is installed, otherwise zlib with a preset
+dictionary). Dictionaries live in the `metadata_dicts` table.
+
+Stored value layout (BLOB): 1-byte codec tag + 4-byte big-endian dict id + payload.
+Dict id 0 means "no dictionary". A TEXT value is plain JSON: either the legacy
+full card dict or an uncompressed residual (recognised by DERIVED_KEY).
+
+Note: the Unity importer (SQLiteCardImporter.cs) reads `metadata` as a JSON
+string, so DBs meant for it should keep the default full mode.
+
+Usage (convert a full-mode DB into a residual-mode copy and report size/timings):
+  python metadata_codec.py --db ws_cards.db --out ws_cards.compact.db
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import time
+import zlib
+
+try:
+    import zstandard
+except Exception:
+    zstandard = None
+
+
+CREATE_DICTS_SQL = """
+CREATE TABLE IF NOT EXISTS metadata_dicts(
+  id INTEGER PRIMARY KEY,
+  codec TEXT NOT NULL,
+  data BLOB NOT NULL,
+  created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# Residual-mode marker: bitmask over MAPPED_KEYS of keys rebuilt from columns.
+DERIVED_KEY = '__derived__'
+# Original key order, when it differs from rebuilt-keys-first: one entry per key,
+# the MAPPED_KEYS index of a rebuilt key or -1 for the next residual key.
+ORDER_KEY = '__order__'
+
+CODEC_ZSTD = 'zstd'
+CODEC_ZLIB = 'zlib'
+CODEC_NONE = 'none'
+CODEC_TAGS = {CODEC_ZSTD: b'Z', CODEC_ZLIB: b'D'}
+TAG_CODECS = {v: k for k, v in CODEC_TAGS.items()}
+HEADER = struct.Struct('>cI')
+
+DICT_SIZE = 16 * 1024
+ZLIB_DICT_MAX = 32 * 1024  # deflate window size
+ZSTD_LEVEL = 19
+
+
+def _text(col):
+    return col
+
+
+def _int_text(col):
+    return None if col is None else str(col)
+
+
+def _json_list(col):
+    return json.loads(col) if col else []
+
+
+# Raw card key -> (column, decode column value back to the raw value).
+# Follows the key lookups in import_to_sqlite.normalize_card.
+MAPPED_KEYS = (
+    ('card_no', 'card_no', _text),
+    ('name', 'name', _text),
+    ('detail_page_url', 'detail_page_url', _text),
+    ('image_url', 'image_url', _text),
+    ('サイド', 'side', _text),
+    ('side', 'side', _text),
+    ('色', 'color', _text),
+    ('color', 'color', _text),
+    ('種類', 'type', _text),
+    ('type', 'type', _text),
+    ('レベル', 'level', _int_text),
+    ('level', 'level', _int_text),
+    ('パワー', 'power', _int_text),
+    ('power', 'power', _int_text),
+    ('コスト', 'cost', _int_text),
+    ('cost', 'cost', _int_text),
+    ('レアリティ', 'rarity', _text),
+    ('rarity', 'rarity', _text),
+    ('トリガー', 'trigger', _text),
+    ('trigger', 'trigger', _text),
+    ('flavor_text', 'flavor_text', _text),
+    ('フレーバー', 'flavor_text', _text),
+    ('flavor', 'flavor_text', _text),
+    ('abilities', 'abilities_json', _json_list),
+    ('特徴', 'traits_json', _json_list),
+)
+
+# Columns needed to rebuild a residual; SELECT these alongside `metadata`.
+SOURCE_COLUMNS = tuple(sorted({col for _, col, _ in MAPPED_KEYS}))
+
+
+def residual_metadata(card: dict, columns: dict) -> dict:
+    """Strip from `card` every mapped key whose value is rebuilt exactly from `columns`."""
+    residual = {}
+    mask = 0
+    order = []
+    mapped = {key: (bit, col, decode) for bit, (key, col, decode) in enumerate(MAPPED_KEYS)}
+    for key, value in card.items():
+        if key in mapped:
+            bit, col, decode = mapped[key]
+            try:
+                rebuilt = decode(columns.get(col))
+            except ValueError:
+                rebuilt = None
+            if rebuilt == value and type(rebuilt) is type(value):
+                mask |= 1 << bit
+                order.append(bit)
+                continue
+        residual[key] = value
+        order.append(-1)
+    residual[DERIVED_KEY] = mask
+    if order != sorted(order, key=lambda bit: (bit < 0, bit)):
+        residual[ORDER_KEY] = order
+    return residual
+
+
+def reconstruct_metadata(residual: dict, columns: dict) -> dict:
+    """Inverse of residual_metadata. Returns the original card, keys in their original order."""
+    residual = dict(residual)
+    mask = residual.pop(DERIVED_KEY, 0)
+    order = residual.pop(ORDER_KEY, None)
+    card = {}
+    for bit, (key, col, decode) in enumerate(MAPPED_KEYS):
+        if mask & (1 << bit):
+            card[key] = decode(columns.get(col))
+    if order is None:
+        card.update(residual)
+        return card
+    rest = iter(residual.items())
+    return dict(next(rest) if bit < 0 else (MAPPED_KEYS[bit][0], card[MAPPED_KEYS[bit][0]]) for bit in order)
+
+
+def dumps_residual(residual: dict) -> bytes:
+    return json.dumps(residual, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def resolve_codec(codec: str) -> str:
+    if codec == 'auto':
+        return CODEC_ZSTD if zstandard else CODEC_ZLIB
+    if codec == CODEC_ZSTD and not zstandard:
+        raise RuntimeError('zstd codec requested but `zstandard` is not installed (`pip install zstandard`)')
+    return codec
+
+
+def train_dictionary(codec: str, samples: list[bytes]) -> bytes | None:
+    """Build a shared dictionary from sample residuals. Returns None if none can be built."""
+    if not samples:
+        return None
+    if codec == CODEC_ZSTD:
+        try:
+            return zstandard.train_dictionary(DICT_SIZE, samples).as_bytes()
+        except zstandard.ZstdError:
+            # too few / too small samples to train; fall through to raw content dictionary
+            pass
+    if codec in (CODEC_ZSTD, CODEC_ZLIB):
+        # zlib has no trainer: use recent sample content as a preset dictionary.
+        # deflate prefers matches near the end of the dictionary, so keep the tail.
+        return b''.join(samples)[-ZLIB_DICT_MAX:]
+    return None
+
+
+class MetadataEncoder:
+    """
+    Encodes residual metadata for one import run.
+
+    The dictionary is trained on the first call to encode_rows() and saved
+    to `metadata_dicts` so later readers can decode the rows.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, codec: str = 'auto'):
+        self.conn = conn
+        self.codec = resolve_codec(codec)
+        self.dict_id = 0
+        self.trained = self.codec == CODEC_NONE
+        self._compress = None
+        conn.execute(CREATE_DICTS_SQL)
+
+    def train(self, samples: list[bytes]) -> None:
+        data = train_dictionary(self.codec, samples)
+        if data:
+            cur = self.conn.execute('INSERT INTO metadata_dicts(codec, data) VALUES(?, ?)', (self.codec, data))
+            self.dict_id = cur.lastrowid
+        self._use_dictionary(data)
+
+    def resume(self) -> 'MetadataEncoder':
+        """Reuse the latest stored dictionary for this codec instead of training a new one."""
+        found = self.conn.execute('SELECT id, data FROM metadata_dicts WHERE codec = ? ORDER BY id DESC LIMIT 1',
+                                  (self.codec,)).fetchone()
+        self.dict_id, data = found if found else (0, None)
+        self._use_dictionary(data)
+        return self
+
+    def _use_dictionary(self, data: bytes | None) -> None:
+        if self.codec == CODEC_ZSTD:
+            cdict = zstandard.ZstdCompressionDict(data) if data else None
+            cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=cdict)
+            self._compress = cctx.compress
+        else:
+            def compress(payload, zdict=data):
+                c = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict) if zdict else \
+                    zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+                return c.compress(payload) + c.flush()
+            self._compress = compress
+        self.trained = True
+
+    def encode(self, payload: bytes):
+        if self.codec == CODEC_NONE:
+            return payload.decode('utf-8')
+        return HEADER.pack(CODEC_TAGS[self.codec], self.dict_id) + self._compress(payload)
+
+    def encode_rows(self, cards: list[dict], rows: list[tuple], metadata_index: int, columns: tuple) -> list[tuple]:
+        """Replace the metadata value of each row tuple with its encoded residual."""
+        payloads = []
+        for card, row in zip(cards, rows):
+            payloads.append(dumps_residual(residual_metadata(card, dict(zip(columns, row)))))
+        if not self.trained:
+            self.train(payloads)
+        out = []
+        for row, payload in zip(rows, payloads):
+            row = list(row)
+            row[metadata_index] = self.encode(payload)
+            out.append(tuple(row))
+        return out
+
+
+def reencode_metadata(conn: sqlite3.Connection, stored, card: dict, columns: dict, encoders: dict) -> object:
+    """
+    Encode an updated `card` in the same storage mode as the existing value `stored`.
+    `columns` are the row's column values after the update; `encoders` caches
+    one resumed MetadataEncoder per codec across calls.
+    """
+    if isinstance(stored, (bytes, memoryview)):
+        codec = TAG_CODECS.get(HEADER.unpack_from(bytes(stored))[0])
+    elif isinstance(stored, str) and DERIVED_KEY in json.loads(stored):
+        codec = CODEC_NONE
+    else:
+        return json.dumps(card, ensure_ascii=False)
+    if codec not in encoders:
+        encoders[codec] = MetadataEncoder(conn, codec).resume()
+    return encoders[codec].encode(dumps_residual(residual_metadata(card, columns)))
+
+
+class MetadataReader:
+    """
+    Transparent accessor for `cards.metadata` in any storage mode.
+
+    Usage:
+        reader = MetadataReader(conn)
+        card = reader.get('DC/W01-001')
+        card = reader.decode(row)  # row: dict with 'metadata' and SOURCE_COLUMNS
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self._dicts: dict[int, tuple[str, bytes]] = {}
+        self._zstd: dict[int, object] = {}
+
+    def _dictionary(self, dict_id: int) -> bytes | None:
+        if dict_id == 0:
+            return None
+        if dict_id not in self._dicts:
+            found = self.conn.execute('SELECT codec, data FROM metadata_dicts WHERE id = ?', (dict_id,)).fetchone()
+            if not found:
+                raise KeyError(f'metadata dictionary {dict_id} not found')
+            self._dicts[dict_id] = found
+        return self._dicts[dict_id][1]
+
+    def _decompress(self, blob: bytes) -> bytes:
+        tag, dict_id = HEADER.unpack_from(blob)
+        payload = blob[HEADER.size:]
+        codec = TAG_CODECS.get(tag)
+        data = self._dictionary(dict_id)
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError('metadata is zstd-compressed but `zstandard` is not installed')
+            if dict_id not in self._zstd:
+                ddict = zstandard.ZstdCompressionDict(data) if data else None
+                self._zstd[dict_id] = zstandard.ZstdDecompressor(dict_data=ddict)
+            return self._zstd[dict_id].decompress(payload)
+        if codec == CODEC_ZLIB:
+            d = zlib.decompressobj(-zlib.MAX_WBITS, zdict=data) if data else zlib.decompressobj(-zlib.MAX_WBITS)
+            return d.decompress(payload) + d.flush()
+        raise ValueError(f'Unknown metadata codec tag: {tag!r}')
+
+    def decode(self, row: dict) -> dict:
+        raw = row.get('metadata')
+        if raw is None:
+            return {}
+        if isinstance(raw, (bytes, memoryview)):
+            raw = self._decompress(bytes(raw))
+        data = json.loads(raw)
+        if not isinstance(data, dict) or DERIVED_KEY not in data:
+            return data
+        return reconstruct_metadata(data, row)
+
+    def get(self, card_no: str) -> dict | None:
+        cols = ('metadata',) + SOURCE_COLUMNS
+        found = self.conn.execute(f'SELECT {",".join(cols)} FROM cards WHERE card_no = ?', (card_no,)).fetchone()
+        if not found:
+            return None
+        return self.decode(dict(zip(cols, found)))
+
+
+# --- Conversion / report ---
+
+def _db_size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def _time_queries(db_path: str, repeat: int = 3) -> dict:
+    queries = {
+        'full_scan': 'SELECT * FROM cards',
+        'metadata_scan': 'SELECT metadata FROM cards',
+        'filter_side_level': "SELECT card_no, name FROM cards WHERE side = 'ヴァイス' AND level >= 2",
+        'by_work_id': 'SELECT * FROM cards WHERE work_id = (SELECT work_id FROM cards LIMIT 1)',
+    }
+    timings = {}
+    conn = sqlite3.connect(db_path)
+    try:
+        for name, sql in queries.items():
+            best = None
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                conn.execute(sql).fetchall()
+                dt = time.perf_counter() - t0
+                best = dt if best is None else min(best, dt)
+            timings[name] = best
+    finally:
+        conn.close()
+    return timings
+
+
+def convert_db(src: str, dst: str, codec: str = 'auto', batch_size: int = 1000) -> dict:
+    """Copy `src` to `dst` and rewrite its metadata column in residual mode. Verifies the round trip."""
+    shutil.copyfile(src, dst)
+    conn = sqlite3.connect(dst)
+    try:
+        encoder = MetadataEncoder(conn, codec)
+        reader = MetadataReader(conn)
+        cols = ('id', 'metadata') + SOURCE_COLUMNS
+        rows = conn.execute(f'SELECT {",".join(cols)} FROM cards ORDER BY id').fetchall()
+        for start in range(0, len(rows), batch_size):
+            batch = [dict(zip(cols, r)) for r in rows[start:start + batch_size]]
+            cards = [reader.decode(r) for r in batch]
+            tuples = [tuple(r[c] for c in cols) for r in batch]
+            encoded = encoder.encode_rows(cards, tuples, 1, cols)
+            conn.executemany('UPDATE cards SET metadata = ? WHERE id = ?', [(e[1], e[0]) for e in encoded])
+            for r, card, e in zip(batch, cards, encoded):
+                r['metadata'] = e[1]
+                if reader.decode(r) != card:
+                    raise AssertionError(f'metadata round trip failed for id={r["id"]}')
+        conn.commit()
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+    return {'rows': len(rows), 'codec': encoder.codec, 'dict_id': encoder.dict_id}
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Convert cards.metadata to compressed residual storage and report size/timings')
+    p.add_argument('--db', '-d', required=True, help='Source SQLite DB (full metadata mode)')
+    p.add_argument('--out', '-o', required=True, help='Output SQLite DB path')
+    p.add_argument('--codec', choices=('auto', CODEC_ZSTD, CODEC_ZLIB, CODEC_NONE), default='auto',
+                   help='Compression codec (auto: zstd if installed, else zlib)')
+    args = p.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        print('DB file not found:', args.db)
+        return 2
+    if os.path.abspath(args.db) == os.path.abspath(args.out):
+        print('--out must differ from --db')
+        return 2
+
+    # timing first: closing the last connection checkpoints any WAL into the main file
+    before = _time_queries(args.db)
+    before_size = _db_size(args.db)
+    info = convert_db(args.db, args.out, codec=args.codec)
+    after = _time_queries(args.out)
+    after_size = _db_size(args.out)
+
+    print(f"Converted {info['rows']} rows (codec={info['codec']}, dict_id={info['dict_id']})")
+    print(f'DB size: {before_size:,} -> {after_size:,} bytes ({after_size / max(before_size, 1):.1%})')
+    print('Query timings (best of 3, ms):')
+    for name in before:
+        print(f'  {name:20} {before[name] * 1000:8.2f} -> {after[name] * 1000:8.2f}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -2,14 +2,20 @@ import json
 import time
 import os
 import re
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
+from collections import deque
 from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit, urlunsplit, parse_qsl, urlencode
+
+try:
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
+except Exception:
+    # parse_card_row is also used by crawl_planner.py, which does not need a browser
+    webdriver = None
 
 # --- 定数 ---
 SEARCH_PAGE_URL = 'https://ws-tcg.com/cardlist/search'
@@ -18,6 +24,18 @@ BASE_URL = 'https://ws-tcg.com/'
 # --- セレクタ ---
 CARD_TABLE_BODY_SELECTOR = 'table.search-result-table > tbody'
 
+def canonicalize_url(url, drop_params=()):
+    """
+    検索結果URLを正規化する（同じ結果ページを一度だけ取得するため）
+    scheme/host の小文字化、fragment と空パラメータの除去、パラメータのソート、page=1 の省略
+    """
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=False)
+             if k not in drop_params and not (k == 'page' and v == '1')]
+    query.sort()
+    path = parts.path or '/'
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), ''))
+
 def parse_card_row(row_soup):
     """
     検索結果テーブルの単一の行(<tr>)からカード情報を抽出する
@@ -156,6 +174,10 @@ def main():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     output_filename = os.path.join(script_dir, 'weiss_schwarz_cards.json')
 
+    if webdriver is None:
+        print("エラー: selenium がインストールされていません (`pip install selenium`)。")
+        return
+
     try:
         chromedriver_path = os.path.join(script_dir, 'chromedriver.exe')
         if not os.path.exists(chromedriver_path):
@@ -178,14 +200,16 @@ def main():
         try:
             wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, CARD_TABLE_BODY_SELECTOR)))
 
-            # BFS-like traversal of pagination links starting from current page
-            visited = set()
-            to_visit = [driver.current_url]
+            # BFS-like traversal of pagination links starting from current page.
+            # URLs are canonicalized so equivalent result pages are fetched once;
+            # `queued` holds everything ever enqueued for O(1) membership checks.
+            # For a full-catalogue crawl prefer crawl_planner.py (partitioned by expansion).
+            start = canonicalize_url(driver.current_url)
+            queued = {start}
+            to_visit = deque([start])
 
             while to_visit:
-                cur = to_visit.pop(0)
-                if cur in visited:
-                    continue
+                cur = to_visit.popleft()
                 
                 print(f"\n--- Processing page: {cur} ---")
                 driver.get(cur)
@@ -193,7 +217,6 @@ def main():
                     wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, CARD_TABLE_BODY_SELECTOR)))
                 except TimeoutException:
                     print(f"タイムアウト: テーブルが見つからないページをスキップします: {cur}")
-                    visited.add(cur)
                     continue
 
                 page_source = driver.page_source
@@ -202,7 +225,6 @@ def main():
 
                 if not table_body:
                     print(f"カード情報テーブルが見つかりませんでした（{cur}）。")
-                    visited.add(cur)
                     continue
 
                 rows = table_body.find_all('tr')
@@ -222,11 +244,11 @@ def main():
                         continue
                     # heuristic: pagination URLs often contain page=, p=, /page/, pg=, paged=
                     if re.search(r'(page=|p=|/page/|pg=|paged=)', href) or a.get('rel') == ['next'] or 'search' in href:
-                        full = urljoin(BASE_URL, href)
-                        if full not in visited and full not in to_visit:
+                        full = canonicalize_url(urljoin(BASE_URL, href))
+                        if full not in queued:
+                            queued.add(full)
                             to_visit.append(full)
 
-                visited.add(cur)
                 # be polite
                 time.sleep(1)
 